@@ -8,7 +8,7 @@ __copyright__ = '2019, Yohann Che<cheyong007@live.com>'
 __docformat__ = 'restructuredtext en'
 
 import socket, time, re
-from threading import Thread
+from threading import Thread, Lock
 from Queue import Queue, Empty
 from urllib import quote
 
@@ -72,15 +72,108 @@ class K17K(Source):
     supports_gzip_transfer_encoding = True
     prefer_results_with_isbn = False
 
+    options = (
+        Option('parse_processes', 'number', 0, _('Parse processes:'),
+            _('Number of worker processes used to parse downloaded 17k.com '
+                'pages. Set it to the number of CPU cores to speed up '
+                'downloading metadata for many books at once. 0 parses the '
+                'pages in the download threads. Changes take effect with the '
+                'next download. Not available on Windows.')),
+        Option('use_list_pages', 'bool', False, _('Use author list pages'),
+            _('When downloading metadata for several books by the same '
+                'author, read the list of the author\'s books once and take '
+                'the metadata of the other books from it. Much faster, but '
+                'the list has no tags, series or last update date and may '
+                'shorten the intro.')),
+    )
+
     MAX_EDITIONS = 5
+    # 进程池解析一个页面的最长等待时间（秒），包括排队时间
+    PARSE_TIMEOUT = 120
     BASE_URL = r"http://www.17k.com"
     BOOK_URL = r"http://www.17k.com/book/"
     SEARCH_URL = r"https://search.17k.com/search.xhtml?c.st=0&c.q="
+    # 预取的列表页元数据的有效时间（秒）
+    PREFETCH_EXPIRY = 3600
     
     idtype = '17k'
 
     def __init__(self, *args, **kwargs):
         Source.__init__(self, *args, **kwargs)
+        self._parse_executor = None
+        self._parse_executor_lock = Lock()
+        self._update_times = None
+        self._identifier_to_metadata_cache = {}
+        self._author_to_url_cache = {}
+        self._author_prefetch_times = {}
+
+    def start_parse_executor(self):
+        '''
+        按选项parse_processes启动进程池解析器。
+        Called by identify and sweep before they start their Workers, so the
+        pool only exists in processes that download metadata, and is started
+        again with the new size after the option changed.
+        '''
+        from calibre_plugins.K17K.parse import ParseExecutor
+        if self.parse_executor is not None:
+            return
+        processes = int(self.prefs['parse_processes'])
+        if processes < 1 or not ParseExecutor.available():
+            return
+        with self._parse_executor_lock:
+            if self._parse_executor is None:
+                try:
+                    self._parse_executor = ParseExecutor(processes)
+                except Exception:
+                    import traceback
+                    traceback.print_exc()
+
+    def stop_parse_executor(self, executor):
+        with self._parse_executor_lock:
+            if self._parse_executor is executor:
+                self._parse_executor = None
+        executor.shutdown()
+
+    @property
+    def parse_executor(self):
+        '''
+        进程池解析器，未启动或选项parse_processes已改变时返回None
+        '''
+        executor = self._parse_executor
+        if executor is not None and \
+                executor.processes != int(self.prefs['parse_processes']):
+            self.stop_parse_executor(executor)
+            executor = None
+        return executor
+
+    @property
+    def update_times(self):
+        '''
+        上次检查时记录的各书籍更新时间 {book_id: 'YYYY-MM-DD HH:MM:SS'}
+        '''
+        if self._update_times is None:
+            from calibre.utils.config import JSONConfig
+            self._update_times = JSONConfig(
+                    'metadata_sources/%s_updates.json'%self.name)
+        return self._update_times
+
+    def parse_page(self, func, raw):
+        '''
+        解析页面原始字节，返回func(raw)的结果。
+        Runs func in the parse executor if one is running, otherwise, or if
+        the executor does not return in PARSE_TIMEOUT seconds, in the calling
+        thread.
+        '''
+        executor = self.parse_executor
+        if executor is not None:
+            try:
+                return executor(func, raw, self.PARSE_TIMEOUT)
+            except Exception:
+                # Stop using the pool only if it died, a busy pool is fine
+                # for the next page
+                if not executor.alive:
+                    self.stop_parse_executor(executor)
+        return func(raw)
 
     def test_fields(self, mi):
         '''
@@ -182,12 +275,66 @@ class K17K(Source):
         return url
     # }}}
 
-    def parse_results_page(self, root):  # {{{
+    def cache_identifier_to_metadata(self, asin, mi):
+        with self.cache_lock:
+            self._identifier_to_metadata_cache[asin] = (time.time(), mi)
+
+    def uncache_identifier_to_metadata(self, asin):
         '''
-        解析搜索结果
+        下载到完整元数据后删除预取的列表页元数据
         '''
-        from lxml.html import tostring
+        with self.cache_lock:
+            self._identifier_to_metadata_cache.pop(asin, None)
 
+    def cache_author_to_url(self, author, url):
+        with self.cache_lock:
+            self._author_to_url_cache[author] = url
+
+    def cached_author_to_url(self, author):
+        with self.cache_lock:
+            return self._author_to_url_cache.get(author, None)
+
+    def author_needs_prefetch(self, author):
+        '''
+        作者主页已知且在PREFETCH_EXPIRY内未读取过时返回True
+        '''
+        with self.cache_lock:
+            if author not in self._author_to_url_cache:
+                return False
+            last = self._author_prefetch_times.get(author, None)
+            return last is None or last < time.time() - self.PREFETCH_EXPIRY
+
+    def cached_metadata(self, title=None, authors=None, identifiers={}):  # {{{
+        '''
+        返回预取缓存中与书号或书名、作者匹配的元数据
+        Entries older than PREFETCH_EXPIRY are dropped.
+        '''
+        asin = self.get_asin(identifiers)
+        with self.cache_lock:
+            cache = self._identifier_to_metadata_cache
+            expired = time.time() - self.PREFETCH_EXPIRY
+            for key, (timestamp, mi) in cache.items():
+                if timestamp < expired:
+                    del cache[key]
+            if asin is not None:
+                entry = cache.get(asin, None)
+                ans = [] if entry is None else [entry[1]]
+            elif title:
+                tokens = list(self.get_title_tokens(title))
+                authors = set(authors or ())
+                ans = [mi for timestamp, mi in cache.itervalues()
+                        if list(self.get_title_tokens(mi.title)) == tokens and
+                        (not authors or authors.intersection(mi.authors))]
+            else:
+                ans = []
+            ans = [mi.deepcopy() for mi in ans[:self.MAX_EDITIONS]]
+        return ans
+    # }}}
+
+    def parse_results_page(self, entries):  # {{{
+        '''
+        从parse_list_page()解析出的搜索结果中选出书籍详情地址
+        '''
         matches = []
 
         def title_ok(title):
@@ -198,15 +345,10 @@ class K17K(Source):
                     return False
             return True
 
-        for a in root.xpath(r'.//div[@class="textmiddle"]/dl/dt[1]/a'):
+        for entry in entries:
             # 获取所有搜索结果的书名
-            title = tostring(a, method='text', encoding=unicode)
-            if title_ok(title):
-                url = a.get('href')
-                if url.startswith('/'):
-                    # 17K页面链接地址href都是“//...”开头，URL加上协议头
-                    url = 'http:%s' % (url)
-                matches.append(url)
+            if title_ok(entry['title']):
+                matches.append(entry['url'])
             if not matches:
                 break;
         # 保留最顶部的前MAX_EDITIONS个匹配的结果，后面的相关度不高, 17K搜索精度不高
@@ -220,18 +362,39 @@ class K17K(Source):
         match is found with identifiers.
         如果使用id未找到匹配，自动不使用id重试查找匹配。
         '''
-        from calibre.utils.cleantext import clean_ascii_chars
-        from calibre.ebooks.chardet import xml_to_unicode
-        from lxml.html import tostring
-        import html5lib
+        from calibre_plugins.K17K.parse import parse_list_page
 
         testing = getattr(self, 'running_a_test', False)
 
+        if self.prefs['use_list_pages']:
+            cached = self.cached_metadata(title=title, authors=authors,
+                    identifiers=identifiers)
+            if not cached:
+                # 已知作者主页时，先读取该作者的全部书籍
+                prefetched = False
+                for author in authors or ():
+                    if self.author_needs_prefetch(author):
+                        self.prefetch(log, abort, author=author,
+                                timeout=timeout)
+                        prefetched = True
+                if prefetched:
+                    cached = self.cached_metadata(title=title,
+                            authors=authors, identifiers=identifiers)
+            if cached:
+                log('Using %d results from 17k.com list pages. They have no '
+                        'tags, series or last update date and the intro may '
+                        'be shortened.'%len(cached))
+                for i, mi in enumerate(cached):
+                    mi.source_relevance = i
+                    result_queue.put(mi)
+                return None
+
         query = self.create_query(log, title=title, authors=authors)
 
         if query is None:
             log.error('Insufficient metadata to construct query')
             return
+        self.start_parse_executor()
         br = self.browser
         if testing:
             print ('Using user agent for 17k.com: %s'%self.user_agent)
@@ -252,37 +415,20 @@ class K17K(Source):
                 log.exception(msg)
             return as_unicode(msg)
 
-        raw = clean_ascii_chars(xml_to_unicode(raw,
-            strip_encoding_pats=True, resolve_entities=True)[0])
-
         if testing:
             import tempfile
             with tempfile.NamedTemporaryFile(prefix='17k_results_',
                     suffix='.html', delete=False) as f:
-                f.write(raw.encode('utf-8'))
+                f.write(raw)
             print ('Downloaded html for results page saved in', f.name)
 
-        matches = []
-        found = '<title>404 - ' not in raw
-
-        if found:
-            try:
-                root = html5lib.parse(raw, treebuilder='lxml',
-                        namespaceHTMLElements=False)
-            except:
-                msg = 'Failed to parse 17k page for query: %r' %query
-                log.exception(msg)
-                return msg
-
-                errmsg = root.xpath('//*[@id="errorMessage"]')
-                if errmsg:
-                    msg = tostring(errmsg, method='text', encoding=unicode).strip()
-                    log.error(msg)
-                    # The error is almost always a not found error
-                    found = False
-
-        if found:
-            matches = self.parse_results_page(root)
+        try:
+            entries = self.parse_page(parse_list_page, raw)[0]
+        except:
+            msg = 'Failed to parse 17k page for query: %r' %query
+            log.exception(msg)
+            return msg
+        matches = self.parse_results_page(entries)
 
         if abort.is_set():
             return
@@ -357,6 +503,198 @@ class K17K(Source):
             log.exception('Failed to download cover from:', cached_url)
     # }}}
 
+    def prefetch(self, log, abort, author=None, category_url=None,
+            max_pages=10, timeout=30):  # {{{
+        '''
+        Page through the books of an author or of a category on 17k.com list
+        pages and cache the metadata and cover url of every listed book, so
+        that identify() and get_cached_cover_url() need no request for them
+        afterwards.
+        按作者或分类翻页读取书籍列表，预先缓存元数据和封面地址。
+
+        author is a name as found by parse_authors, its page is the one linked
+        from the details page of one of the author's books, so identify must
+        have seen such a book first. category_url is the first list page of a
+        category, as linked from 17k.com. Further pages are found through the
+        next page link of each page.
+        Returns the ids of the cached books.
+        '''
+        from urlparse import urljoin
+        from calibre_plugins.K17K.parse import parse_list_page
+
+        if author:
+            url = self.cached_author_to_url(author)
+            if url is None:
+                log.error('No author page known for %r, identify one of '
+                        'their books first'%author)
+                return []
+            with self.cache_lock:
+                self._author_prefetch_times[author] = time.time()
+        elif category_url:
+            url = category_url
+        else:
+            log.error('Prefetch needs an author or a category')
+            return []
+
+        self.start_parse_executor()
+        br = self.browser
+        cached = []
+        pages = 0
+        while url and pages < max_pages and not abort.is_set():
+            try:
+                raw = br.open_novisit(url, timeout=timeout).read().strip()
+                entries, next_url = self.parse_page(parse_list_page, raw)
+            except:
+                log.exception('Failed to prefetch list page: %r'%url)
+                break
+            pages += 1
+
+            new = 0
+            for entry in entries:
+                asin = entry['asin']
+                # 作者主页上的书籍可能没有作者链接
+                authors = entry['authors'] or ([author] if author else [])
+                if asin in cached or not entry['title'] or not authors:
+                    continue
+                if author and author not in authors:
+                    continue
+                title = re.sub(r'[(\[].*[)\]]', '', entry['title']).strip()
+                mi = Metadata(title, authors)
+                mi.set_identifier(self.idtype, asin)
+                if entry['comments']:
+                    mi.comments = entry['comments']
+                mi.has_cover = bool(entry['cover_url'])
+                mi.languages = [u'中文',]
+                self.clean_downloaded_metadata(mi)
+                self.cache_identifier_to_metadata(asin, mi)
+                if entry['cover_url']:
+                    self.cache_identifier_to_cover_url(asin,
+                            entry['cover_url'])
+                cached.append(asin)
+                new += 1
+            # 没有新书籍时说明已翻到最后一页
+            if not new:
+                break
+            url = urljoin(url, next_url) if next_url else None
+        log('Prefetched %d books from %d pages'%(len(cached), pages))
+        return cached
+    # }}}
+
+    def sweep(self, log, result_queue, abort, books, list_urls=(),
+            timeout=30):  # {{{
+        '''
+        Refresh only the books that were updated on 17k.com since the last
+        sweep. books is a list of identifiers dicts, the metadata of changed
+        books is put into result_queue with the cover in cover_data.
+        检查书籍的更新时间，只重新下载有更新的书籍的元数据和封面。
+
+        list_urls are search or list pages showing the update time of many
+        books at once. A book found there needs no further request when the
+        page shows its update time as precisely as the recorded one. List
+        pages that only show the date cannot tell a second update on the same
+        day, so then the details page is checked as for books not listed.
+        The details page is parsed in full straight away when the book has
+        changed.
+
+        Returns {book_id: update time} for the refreshed books. Nothing is
+        recorded by sweep itself: pass the times of the books whose metadata
+        was applied to record_update_times(), so that a book that failed to
+        apply is refreshed again by the next sweep.
+        '''
+        from calibre_plugins.K17K.parse import (parse_list_page,
+                same_update_time)
+        from calibre_plugins.K17K.worker import Worker
+
+        self.start_parse_executor()
+        store = self.update_times
+        asins = []
+        for identifiers in books:
+            asin = self.get_asin(identifiers)
+            if asin and asin not in asins:
+                asins.append(asin)
+
+        br = self.browser
+        listed = {}
+        for url in list_urls:
+            if abort.is_set():
+                return {}
+            try:
+                raw = br.open_novisit(url, timeout=timeout).read().strip()
+                entries = self.parse_page(parse_list_page, raw)[0]
+            except:
+                log.exception('Failed to read update times from: %r'%url)
+                continue
+            for entry in entries:
+                if entry['last_modified']:
+                    listed[entry['asin']] = entry['last_modified']
+
+        tasks = []
+        for asin in asins:
+            since = store.get(asin, None)
+            if since and asin in listed:
+                same = same_update_time(since, listed[asin])
+                if same:
+                    continue
+                if same is not None:
+                    # 列表页已显示有更新，不必再比较详情页
+                    since = None
+            tasks.append((asin, since))
+        log('Checking %d of %d books for updates'%(len(tasks), len(asins)))
+
+        rq = Queue()
+        refreshed = {}
+        # Run the workers in batches, like identify does for a single search.
+        # Each batch creates its workers only when it runs, as every worker
+        # clones the browser.
+        for i in xrange(0, len(tasks), self.MAX_EDITIONS):
+            workers = [Worker('%s%s.html'%(self.BOOK_URL, asin), rq, br, log,
+                i + j, self, timeout=timeout, since=since)
+                for j, (asin, since) in enumerate(tasks[i:i+self.MAX_EDITIONS])]
+            for w in workers:
+                w.start()
+                time.sleep(0.1)
+            for w in workers:
+                while w.is_alive() and not abort.is_set():
+                    w.join(0.2)
+            if abort.is_set():
+                break
+
+            last_modified = dict((w.k17k_id, w.last_modified) for w in workers
+                    if w.k17k_id)
+            while True:
+                try:
+                    mi = rq.get_nowait()
+                except Empty:
+                    break
+                asin = mi.get_identifiers().get(self.idtype, None)
+                cover_url = self.cached_identifier_to_cover_url(asin)
+                if cover_url:
+                    try:
+                        cdata = br.open_novisit(cover_url,
+                                timeout=timeout).read()
+                        if cdata:
+                            mi.cover_data = ('jpg', cdata)
+                    except:
+                        log.exception('Failed to download cover from:',
+                                cover_url)
+                # 详情页没有更新时间时使用列表页的
+                refreshed[asin] = last_modified.get(asin) or listed.get(asin)
+                result_queue.put(mi)
+
+        return refreshed
+    # }}}
+
+    def record_update_times(self, times):
+        '''
+        记录已应用的书籍更新时间，times为sweep()返回值或其一部分。
+        The file is written once for all of them.
+        '''
+        times = dict((k, v) for k, v in times.iteritems() if v)
+        if times:
+            store = self.update_times
+            store.update(times)
+            store.commit()
+
 if __name__ == '__main__':  # tests {{{
     # To run these test use: calibre-debug -e __init__.py
     from calibre.ebooks.metadata.sources.test import (test_identify_plugin,
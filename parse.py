@@ -0,0 +1,411 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2019, Yohann Che<cheyong007@live.com>'
+__docformat__ = 'restructuredtext en'
+
+'''
+Parse 17k.com pages into plain field dicts.
+把17K页面解析为简单的字段字典。
+
+Everything here works on the raw page bytes only and touches neither the
+network nor the calibre log, so it can run in the Worker thread or in a
+worker process of a ParseExecutor.
+'''
+
+import re, traceback, atexit
+from threading import Lock
+
+COVER_URL_XPATH = './/div[@class="cover"]/a/img'
+TITLE_XPATH = './/div[@class="BookInfo"]//h1/a/text()'
+AUTHOR_XPATH = './/div[@class="author"]/a[@class="name"]/text()'
+AUTHOR_URL_XPATH = './/div[@class="author"]/a[@class="name"]/@href'
+SERIES_XPATH = './/div[@class="infoPath"]/div/a[3]/text()'
+TAGS_XPATH = './/tr[@class="label"]/td[@colspan="3"]/a/span/text()'
+COMMENTS_XPATH = './/p[@class="intro"]/a/text()'
+LAST_MODIFIED_XPATH = './/dl[@id="bookInfo"]/dt[@class="tit"]/em/text()'
+K17K_ID_XPATH = './/div[@class="infoPath"]//span/text()'
+# 搜索结果页中每本书为一个dl，分类列表页中为表格的一行
+LIST_ENTRY_XPATHS = (
+        './/div[@class="textmiddle"]/dl',
+        './/table//tr[.//a[contains(@href, "/book/")]]',
+        )
+LIST_BOOK_LINK_XPATH = './/a[contains(@href, "/book/")]'
+LIST_AUTHOR_XPATH = './/a[contains(@href, "user.17k.com")]'
+LIST_INTRO_XPATH = './/*[@class="intro"]'
+# 搜索结果的封面在dl外的相邻div中
+LIST_COVER_XPATHS = ('.//img', '../preceding-sibling::div[1]//img')
+NEXT_PAGE_XPATH = './/a[contains(text(), "下一页")]'
+
+BOOK_ID_PAT = re.compile(r'/book/(\d+)\.html')
+DATE_PAT = (r'(\d{4})-(\d{1,2})-(\d{1,2})'
+        r'(?:\s+(\d{1,2}):(\d{2})(?::(\d{2}))?)?')
+UPDATE_TIME_PAT = re.compile(r'更新\D{0,8}?' + DATE_PAT)
+# 分类列表页的更新时间单独一列，没有“更新”字样，只匹配仅含时间的单元格
+BARE_UPDATE_TIME_PAT = re.compile(r'^\s*' + DATE_PAT + r'\s*$')
+LIST_CELL_XPATH = './td'
+
+SERIES_PAT = re.compile(
+        r'''
+        \|\s*              # Prefix
+        (Series)\s*:\s*    # Series declaration
+        (?P<series>.+?)\s+  # The series name
+        \((Book)\s*    # Book declaration
+        (?P<index>[0-9.]+) # Series index
+        \s*\)
+        ''', re.X)
+
+
+def parse_root(raw):
+    '''
+    把页面原始字节解析为lxml树，404页面返回None
+    '''
+    from calibre.utils.cleantext import clean_ascii_chars
+    from calibre.ebooks.chardet import xml_to_unicode
+    import html5lib
+
+    raw = xml_to_unicode(raw, strip_encoding_pats=True,
+            resolve_entities=True)[0]
+    if '<title>404 - ' in raw:
+        return None
+    return html5lib.parse(clean_ascii_chars(raw), treebuilder='lxml',
+            namespaceHTMLElements=False)
+
+
+def parse_asin(root):
+    #解析book ID
+    id_list = root.xpath(K17K_ID_XPATH)
+    if id_list:
+        book_num = id_list[0]
+        id_pattern = r'\[书号(\d+)\]'
+        return re.findall(id_pattern, book_num)[0]
+
+
+def parse_title(root):
+    # 解析书名
+    title_name = root.xpath(TITLE_XPATH)
+    if title_name:
+        title = title_name[0]
+        return re.sub(r'[(\[].*[)\]]', '', title).strip()
+
+
+def parse_authors(root):
+    #解析作者
+    aus = root.xpath(AUTHOR_XPATH)
+    authors = []
+    if aus:
+        authors.append(unicode(aus[0]))
+    return authors
+
+
+def absolute_url(url):
+    # 17K页面链接地址href都是“//...”开头，加上协议头
+    if url and url.startswith('//'):
+        url = 'http:%s' % url
+    elif url and url.startswith('/'):
+        url = 'http://www.17k.com%s' % url
+    return url
+
+
+def parse_author_url(root):
+    #解析作者主页地址
+    hrefs = root.xpath(AUTHOR_URL_XPATH)
+    if hrefs:
+        return absolute_url(hrefs[0].strip())
+
+
+def parse_comments(root):
+    #解析注释
+    ans = ''
+    desc = root.xpath(COMMENTS_XPATH)
+    if desc:
+        ans = desc[0].strip()
+    return ans
+
+
+def parse_series(root):
+    # 解析丛书系列
+    ans = (None, None)
+    desc = root.xpath(SERIES_XPATH)
+    if desc:
+        raw = desc[0].encode(encoding='raw_unicode_escape')
+        raw = re.sub(r'\s+', ' ', raw)
+        match = SERIES_PAT.search(raw)
+        if match is not None:
+            s, i = match.group('series'), float(match.group('index'))
+            if s:
+                ans = (s, i)
+    return ans
+
+
+def parse_tags(root):
+    #解析标签
+    return [unicode(li) for li in root.xpath(TAGS_XPATH)]
+
+
+def parse_cover_src(root):
+    #解析页面中的封面地址
+    imgs = root.xpath(COVER_URL_XPATH)
+    if imgs:
+        # https://cdn.static.17k.com/book/189x272/17/64/2476417.jpg-189x272?v=0
+        src = imgs[0].get('src')
+        if src:
+            return src.split('-')[0]
+
+
+def cover_url_for(asin):
+    '''
+    由书号生成17K封面地址
+    '''
+    return 'https://cdn.static.17k.com/book/189x272/%s/%s/%s.jpg' % (
+            asin[-2:], asin[-4:-2], asin)
+
+
+def parse_update_time(text, pat=UPDATE_TIME_PAT):
+    '''
+    从“更新: 2019-08-23 12:00”形式的文本中解析更新时间，
+    返回 'YYYY-MM-DD[ HH:MM[:SS]]' 形式的字符串，找不到时返回None
+    '''
+    match = pat.search(text)
+    if match is None:
+        return None
+    parts = [int(x) for x in match.groups() if x is not None]
+    ans = '%04d-%02d-%02d' % tuple(parts[:3])
+    if len(parts) > 3:
+        ans += ' ' + ':'.join('%02d' % x for x in parts[3:])
+    return ans
+
+
+def same_update_time(a, b):
+    '''
+    比较两个parse_update_time()的结果。
+    Returns None when only one of them has the time of day, as list pages
+    may only show the date and a book can be updated several times a day.
+    '''
+    if len(a) != len(b):
+        return None
+    return a == b
+
+
+def parse_last_modified(root):
+    #解析最后更新日期
+    lm = root.xpath(LAST_MODIFIED_XPATH)
+    if lm:
+        return parse_update_time(lm[0])
+
+
+def parse_details_page(raw):
+    '''
+    解析书籍详情页，返回字段字典。
+    Returns None for a 404 page. Fields that fail to parse are left at their
+    defaults and the traceback is recorded under "errors" so the caller can
+    log it.
+    '''
+    from lxml.html import tostring
+
+    root = parse_root(raw)
+    if root is None:
+        return None
+
+    ans = {'errors': []}
+    errmsg = root.xpath('//*[@id="errorMessage"]')
+    if errmsg:
+        ans['error'] = tostring(errmsg[0], method='text',
+                encoding=unicode).strip()
+        return ans
+
+    for field, func, default in (
+            ('asin', parse_asin, None),
+            ('title', parse_title, None),
+            ('authors', parse_authors, []),
+            ('author_url', parse_author_url, None),
+            ('comments', parse_comments, None),
+            ('series', parse_series, (None, None)),
+            ('tags', parse_tags, None),
+            ('cover_src', parse_cover_src, None),
+            ('last_modified', parse_last_modified, None),
+            ):
+        try:
+            ans[field] = func(root)
+        except Exception:
+            ans[field] = default
+            ans['errors'].append((field, traceback.format_exc()))
+    return ans
+
+
+def parse_list_page(raw):
+    '''
+    解析搜索结果页或作者、分类的书籍列表页，一次取得页面上所有书籍的
+    asin, url, title, authors, comments, cover_url 和 last_modified 字段。
+    Returns (entries, url of the next page or None).
+    '''
+    from lxml.html import tostring
+
+    def text(elem):
+        return tostring(elem, method='text', encoding=unicode).strip()
+
+    root = parse_root(raw)
+    if root is None:
+        return [], None
+
+    ans = []
+    for xpath in LIST_ENTRY_XPATHS:
+        for entry in root.xpath(xpath):
+            # 分类列表的行中也有 /all/book/... 形式的分类链接
+            for link in entry.xpath(LIST_BOOK_LINK_XPATH):
+                match = BOOK_ID_PAT.search(link.get('href') or '')
+                if match is not None:
+                    break
+            else:
+                continue
+            cover_url = None
+            for cover_xpath in LIST_COVER_XPATHS:
+                srcs = [img.get('src') for img in entry.xpath(cover_xpath)]
+                srcs = [x for x in srcs if x]
+                if srcs:
+                    cover_url = absolute_url(srcs[0].split('-')[0])
+                    break
+            authors = [text(a) for a in entry.xpath(LIST_AUTHOR_XPATH)]
+            intro = entry.xpath(LIST_INTRO_XPATH)
+            last_modified = parse_update_time(text(entry))
+            if last_modified is None:
+                for cell in entry.xpath(LIST_CELL_XPATH):
+                    last_modified = parse_update_time(text(cell),
+                            BARE_UPDATE_TIME_PAT)
+                    if last_modified:
+                        break
+            ans.append({
+                'asin': match.group(1),
+                'url': absolute_url(link.get('href')),
+                'title': text(link),
+                'authors': [a for a in authors if a][:1],
+                'comments': text(intro[0]) if intro else None,
+                'cover_url': cover_url,
+                'last_modified': last_modified,
+            })
+        if ans:
+            break
+
+    next_url = None
+    for a in root.xpath(NEXT_PAGE_XPATH):
+        href = a.get('href')
+        if href and not href.startswith('javascript'):
+            next_url = absolute_url(href)
+            break
+    return ans, next_url
+
+
+class ParseExecutor(object):
+
+    '''
+    Run the parse functions of this module in a pool of worker processes,
+    so that the html5lib parsing of many pages is not serialized by the GIL.
+    Network I/O stays in the calling threads, only the raw page bytes and the
+    resulting field dicts cross the process boundary.
+    用进程池解析页面，网络请求仍在线程中进行。
+
+    The pool forks its processes when it is created. The modules the parse
+    functions need are imported first, so that the processes do not have to
+    import anything while other threads of the parent may hold locks. It is
+    not available on Windows, where the processes are spawned afresh and
+    cannot import calibre_plugins.
+    '''
+
+    def __init__(self, processes):
+        from multiprocessing import Pool
+        # Import everything parse_root() needs before forking
+        from calibre.utils.cleantext import clean_ascii_chars
+        from calibre.ebooks.chardet import xml_to_unicode
+        from lxml.html import tostring
+        import html5lib
+        self.processes = processes
+        self.lock = Lock()
+        self.pool = Pool(processes)
+        atexit.register(self.shutdown)
+
+    @staticmethod
+    def available():
+        '''
+        当前平台是否可以使用进程池
+        '''
+        from calibre.constants import iswindows
+        return not iswindows
+
+    @property
+    def alive(self):
+        '''
+        进程池是否仍在运行
+        '''
+        from multiprocessing.pool import RUN
+        with self.lock:
+            pool = self.pool
+        return pool is not None and pool._state == RUN
+
+    def __call__(self, func, raw, timeout=None):
+        '''
+        在进程池中执行func(raw)并返回其结果，异常会在调用线程中重新抛出
+        '''
+        with self.lock:
+            pool = self.pool
+        if pool is None:
+            raise RuntimeError('The parse executor has been shut down')
+        res = pool.apply_async(func, (raw,))
+        # AsyncResult.get() with no timeout cannot be interrupted in python 2
+        return res.get(timeout or 3600)
+
+    def shutdown(self):
+        with self.lock:
+            pool, self.pool = self.pool, None
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+
+if __name__ == '__main__':  # benchmark {{{
+    # To run this benchmark use:
+    # calibre-debug -e parse.py -- /path/to/saved_details_page.html ...
+    # Saved pages can be produced by running the identify tests, which dump
+    # every downloaded details page to a temporary file.
+    import sys, os, time
+    from threading import Thread
+
+    # The pool pickles functions by module name, so they must come from a
+    # real module rather than from this script run as __main__
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from parse import parse_details_page, ParseExecutor
+
+    pages = []
+    for path in sys.argv[1:]:
+        with open(path, 'rb') as f:
+            pages.append(f.read())
+    if not pages:
+        raise SystemExit('Usage: calibre-debug -e parse.py -- page.html ...')
+    # Enough pages that every process has work for a while
+    pages = pages * max(1, 64 // len(pages))
+
+    def run(parse):
+        # Parse all pages from five threads, like a bulk identify run
+        chunks = [pages[i::5] for i in range(5)]
+
+        def work(chunk):
+            for raw in chunk:
+                parse(parse_details_page, raw)
+        threads = [Thread(target=work, args=(c,)) for c in chunks]
+        st = time.time()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return len(pages) / (time.time() - st)
+
+    print('threads only: %.1f pages/sec' % run(lambda func, raw: func(raw)))
+    for processes in (1, 2, 4, 8):
+        executor = ParseExecutor(processes)
+        try:
+            print('%d processes: %.1f pages/sec' % (processes, run(executor)))
+        finally:
+            executor.shutdown()
+# }}}